@@ -6,7 +6,9 @@ script then creates in HDX.
 """
 
 import logging
+from functools import cache
 from os.path import dirname, expanduser, join
+from typing import List
 
 from hdx.api.configuration import Configuration
 from hdx.facades.infer_arguments import facade
@@ -25,6 +27,12 @@ logger = logging.getLogger(__name__)
 _USER_AGENT_LOOKUP = "hdx-scraper-cod-population"
 _SAVED_DATA_DIR = "saved_data"  # Keep in repo to avoid deletion in /tmp
 _UPDATED_BY_SCRIPT = "HDX Scraper: cod-population"
+_DATASET_STATIC_YAML = join(dirname(__file__), "config", "hdx_dataset_static.yaml")
+
+
+@cache
+def _get_countryiso3s() -> List[str]:
+    return list(Country.countriesdata()["countries"])
 
 
 def main(
@@ -53,18 +61,15 @@ def main(
                     use_saved=use_saved,
                 )
                 configuration = Configuration.read()
-                countryiso3s = [key for key in Country.countriesdata()["countries"]]
+                countryiso3s = _get_countryiso3s()
 
                 # Steps to generate dataset
                 cod_population = CODPopulation(
                     configuration, retriever, temp_dir, errors_on_exit
                 )
-                for iso3 in countryiso3s:
-                    cod_population.download_country_data(iso3)
+                cod_population.download_all_country_data(countryiso3s)
                 dataset = cod_population.generate_dataset()
-                dataset.update_from_yaml(
-                    path=join(dirname(__file__), "config", "hdx_dataset_static.yaml")
-                )
+                dataset.update_from_yaml(path=_DATASET_STATIC_YAML)
                 dataset.create_in_hdx(
                     remove_additional_resources=True,
                     match_resource_order=False,
@@ -77,7 +82,7 @@ def main(
                     errors = errors_on_exit.errors
                     errors = ["The following errors were found"] + sorted(errors)
                     with open("errors.txt", "w") as fp:
-                        fp.writelines(_ + " | " for _ in errors)
+                        fp.write(" | ".join(errors) + " | ")
                 logger.info("Finished processing")
 
 
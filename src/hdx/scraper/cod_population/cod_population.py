@@ -3,7 +3,10 @@
 
 import logging
 import re
-from typing import List, Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, FrozenSet, List, Tuple
 from unicodedata import normalize
 
 from hdx.api.configuration import Configuration
@@ -13,11 +16,34 @@ from hdx.data.resource import Resource
 from hdx.location.country import Country
 from hdx.utilities.base_downloader import DownloadError
 from hdx.utilities.dictandlist import dict_of_lists_add, dict_of_sets_add
+from hdx.utilities.downloader import Download
 from hdx.utilities.errors_onexit import ErrorsOnExit
 from hdx.utilities.retriever import Retrieve
 
 logger = logging.getLogger(__name__)
 
+# Patterns are matched against lowercased headers and resource names
+_ADM_RESOURCE_PATTERNS = [
+    re.compile(f"adm(in)?{admin_level}", re.ASCII) for admin_level in range(5)
+]
+# Lowercase prefixes matching adm(in)?[0-4]_?p?code
+_CODE_PREFIXES = tuple(
+    f"{adm}{admin_level}{separator}{p}code"
+    for adm in ("adm", "admin")
+    for admin_level in range(5)
+    for separator in ("", "_")
+    for p in ("", "p")
+)
+# The name header pattern captures the admin level of the header
+_NAME_PATTERN = re.compile(
+    "adm(?:in)?([0-4])(?:name)?_?(?:name|[a-z][a-z])$|name_?([0-4])$", re.ASCII
+)
+# Total (F_TL), range (F_00_04, F_0004) or plus (F_80plus, F_80_plus) headers
+_POPULATION_HEADER_PATTERN = re.compile(
+    "[fmt]_(tl|[0-9]{1,3}_?[0-9]{1,3}|[0-9]{2,3}_?plus)", re.ASCII
+)
+_YEAR_PATTERN = re.compile("(?<![0-9])2[0-9]{3}(?![0-9])", re.ASCII)
+
 
 class CODPopulation:
     def __init__(
@@ -35,136 +61,231 @@ class CODPopulation:
         self.errors = errors
         self._nonmatching_headers = {}
         self._year_sources = {}
+        self._known_errors = frozenset(configuration["known_errors"])
+        self._encoding_exceptions = configuration["encoding_exceptions"]
+        self._reference_year_exceptions = configuration["reference_year_exceptions"]
+        self._non_latin_alphabets = frozenset(configuration["non_latin_alphabets"])
 
     def download_country_data(self, iso3: str) -> None:
+        country_data = self._read_country_data(iso3, self._retriever)
+        self._add_country_data(iso3, country_data)
+
+    def download_all_country_data(
+        self, countryiso3s: List[str], max_workers: int = 10
+    ) -> None:
+        # Each thread gets its own downloader, so responses are not shared, but all
+        # use the retriever's session deliberately so that its connection pool is
+        # reused. The session is only used for GET requests and is not modified
+        # while the threads run. Downloaded files are prefixed by country, so
+        # threads never write to the same path. Results are added in the order of
+        # countryiso3s so output matches a serial run.
+        session = self._retriever.downloader.session
+        local = threading.local()
+        downloaders = []
+
+        def read_country_data(iso3: str) -> Dict | None:
+            retriever = getattr(local, "retriever", None)
+            if retriever is None:
+                downloader = Download(session=session)
+                downloaders.append(downloader)
+                retriever = self._retriever.clone(downloader)
+                local.retriever = retriever
+            return self._read_country_data(iso3, retriever)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = executor.map(read_country_data, countryiso3s)
+                for iso3, country_data in zip(countryiso3s, results):
+                    self._add_country_data(iso3, country_data)
+        finally:
+            # Close each worker's last response but leave the shared session open
+            for downloader in downloaders:
+                downloader.close_response()
+
+    def _add_country_data(self, iso3: str, country_data: Dict | None) -> None:
+        if country_data is None:
+            return
+        dict_of_lists_add(self.metadata, "countries", iso3)
+        for reference_year in country_data["reference_years"]:
+            dict_of_sets_add(self.metadata, "reference_year", reference_year)
+        for admin_level, population_rows in country_data["data"].items():
+            if population_rows:
+                self.data.setdefault(admin_level, []).extend(population_rows)
+        for error in country_data["errors"]:
+            self.errors.add(error)
+        for year_source in country_data["year_sources"]:
+            dict_of_sets_add(self._year_sources, iso3, year_source)
+        for header in country_data["nonmatching_headers"]:
+            dict_of_sets_add(self._nonmatching_headers, iso3, header)
+
+    def _read_country_data(self, iso3: str, retriever: Retrieve) -> Dict | None:
         dataset_name = f"cod-ps-{iso3.lower()}"
         try:
             dataset = Dataset.read_from_hdx(dataset_name)
         except HDXError:
             logger.info(f"Can't read dataset for {iso3}")
-            return
+            return None
         if not dataset:
-            return
+            return None
         if dataset["archived"] or dataset.get("cod_level") is None:
-            return
+            return None
 
         logger.info(f"Downloading population data for {iso3}")
         year_end = int(dataset.get_time_period(date_format="%Y")["enddate_str"])
         source = dataset["dataset_source"]
         organization = dataset.get_organization()["display_name"]
-        dict_of_lists_add(self.metadata, "countries", iso3)
+        country_name = Country.get_country_name_from_iso3(iso3)
+        data = {}
+        reference_years = set()
+        errors = []
+        year_sources = set()
+        nonmatching_headers = set()
+
+        # Find the csv resources for each admin level
+        resources_by_level = {admin_level: [] for admin_level in range(0, 5)}
+        for resource in dataset.get_resources():
+            if resource.get_format() != "csv":
+                continue
+            resource_name = resource["name"].lower()
+            for admin_level, pattern in enumerate(_ADM_RESOURCE_PATTERNS):
+                if pattern.search(resource_name):
+                    resources_by_level[admin_level].append(resource)
 
         missing_levels = []
         for admin_level in range(0, 5):
             population_rows = []
             country_keys = set()
             duplicates = 0
-            # Find a csv resource for each admin level
-            adm_resources = [
-                r
-                for r in dataset.get_resources()
-                if r.get_format() == "csv"
-                and re.match(f".*adm(in)?{admin_level}.*", r["name"], re.IGNORECASE)
-            ]
+            adm_resources = resources_by_level[admin_level]
             if len(adm_resources) == 0:
                 missing_levels.append(admin_level)
                 continue
             if len(adm_resources) > 1:
                 adm_resources = _select_latest_resource(adm_resources)
             if len(adm_resources) > 1:
-                self.errors.add(f"{iso3}: more than one adm{admin_level} resource found")
+                errors.append(f"{iso3}: more than one adm{admin_level} resource found")
                 continue
             resource = adm_resources[0]
             url = resource["url"]
-            encoding = self._configuration["encoding_exceptions"].get(
-                resource["name"], "utf-8"
-            )
+            encoding = self._encoding_exceptions.get(resource["name"], "utf-8")
             try:
-                headers, rows = self._retriever.get_tabular_rows(url, encoding=encoding)
+                # Prefix files with the country so that resources with the same
+                # file name in different countries are saved to different paths
+                headers, rows = retriever.get_tabular_rows(
+                    url, encoding=encoding, file_prefix=iso3.lower()
+                )
             except DownloadError:
-                self.errors.add(f"{iso3}: download failed for {resource['name']}")
+                errors.append(f"{iso3}: download failed for {resource['name']}")
                 continue
-            # Find the correct p-code header and admin name headers
-            adm_code_headers = {}
-            adm_name_headers = {}
+            # Find the correct p-code header and admin name header columns
+            lower_headers = [header.lower() for header in headers]
+            level_code_headers, level_name_headers = _get_admin_headers(lower_headers)
+            adm_code_columns = {}
+            adm_name_columns = {}
             for adm_level in range(1, admin_level + 1):
-                code_headers = _get_code_headers(headers, adm_level)
-                name_headers = _get_name_headers(
-                    headers, adm_level, self._configuration["non_latin_alphabets"]
+                code_headers = level_code_headers.get(adm_level, [])
+                name_headers = _select_name_headers(
+                    level_name_headers.get(adm_level, []), self._non_latin_alphabets
                 )
                 if len(code_headers) == 0:
-                    self.errors.add(
+                    errors.append(
                         f"{iso3}: adm{adm_level} code header not found in adm{admin_level}"
                     )
                 else:
-                    adm_code_headers[adm_level] = code_headers[0]
+                    adm_code_columns[adm_level] = lower_headers.index(code_headers[0])
                 if len(name_headers) == 0:
-                    self.errors.add(
+                    errors.append(
                         f"{iso3}: adm{adm_level} name header not found in adm{admin_level}"
                     )
                 else:
-                    adm_name_headers[adm_level] = name_headers[0]
-            reference_year = self._configuration["reference_year_exceptions"].get(
-                resource["name"]
-            )
+                    adm_name_columns[adm_level] = lower_headers.index(name_headers[0])
+            reference_year = self._reference_year_exceptions.get(resource["name"])
             resource_year = _get_resource_year(resource["name"])
             date_header = headers.index("year") if "year" in headers else None
             if reference_year:
-                dict_of_sets_add(self._year_sources, iso3, "exception")
+                year_sources.add("exception")
+            latin_1 = encoding == "latin-1"
+            normalized_names = {}
+            population_headers = []
+            added_year = None
+            for header_i, header in enumerate(headers):
+                if not _match_population_header(lower_headers[header_i]):
+                    nonmatching_headers.add(header)
+                    continue
+                gender, age_range = _get_gender_and_age_range(header)
+                min_age, max_age = _get_min_and_max_age(age_range)
+                if max_age and min_age and max_age < min_age:
+                    errors.append(f"{iso3}: adm{admin_level} has weird header {header}")
+                    continue
+                population_headers.append(
+                    (header_i, header.upper(), gender, age_range, min_age, max_age)
+                )
+            # Output keys and column indices of the admin codes and names
+            admin_columns = [
+                (
+                    f"ADM{adm_level}_PCODE",
+                    adm_code_columns.get(adm_level),
+                    f"ADM{adm_level}_NAME",
+                    adm_name_columns.get(adm_level),
+                )
+                for adm_level in range(1, admin_level + 1)
+            ]
             for row in rows:
-                row_non_null = [r for r in row if r]
-                if "#" in row_non_null[0]:
+                # Skip blank rows and the HXL hashtag row
+                first_value = next((r for r in row if r), None)
+                if first_value is None or first_value.startswith("#"):
                     continue
                 if not reference_year:
                     if date_header is not None:
                         reference_year = int(row[date_header])
-                        dict_of_sets_add(self._year_sources, iso3, "date header")
+                        year_sources.add("date header")
                     elif resource_year != -1:
                         reference_year = resource_year
-                        dict_of_sets_add(self._year_sources, iso3, "resource name")
+                        year_sources.add("resource name")
                     else:
                         reference_year = year_end
-                        dict_of_sets_add(self._year_sources, iso3, "dataset date")
-                dict_of_sets_add(self.metadata, "reference_year", reference_year)
-                adm_codes = {}
-                adm_names = {}
-                for adm_level in range(1, admin_level + 1):
-                    adm_code_header = adm_code_headers.get(adm_level)
-                    if adm_code_header:
-                        adm_codes[adm_level] = row[headers.index(adm_code_header)]
-                    adm_name_header = adm_name_headers.get(adm_level)
-                    if adm_name_header:
-                        adm_name = row[headers.index(adm_name_header)]
-                        if encoding == "latin-1":
-                            try:
-                                adm_name = normalize(
-                                    "NFKD",
-                                    adm_name.encode("latin-1", "ignore").decode("utf-8"),
-                                )
-                            except UnicodeDecodeError:
-                                pass
-                        adm_names[adm_level] = adm_name
-
-                for header_i, header in enumerate(headers):
-                    if not _match_population_header(header):
-                        dict_of_sets_add(self._nonmatching_headers, iso3, header)
+                        year_sources.add("dataset date")
+                # The reference year is fixed once set, so only add it on change
+                if reference_year != added_year:
+                    reference_years.add(reference_year)
+                    added_year = reference_year
+                admin_row = {
+                    "ISO3": iso3,
+                    "Country": country_name,
+                }
+                for pcode_key, code_i, name_key, name_i in admin_columns:
+                    admin_row[pcode_key] = None if code_i is None else row[code_i]
+                    if name_i is None:
+                        admin_row[name_key] = None
                         continue
+                    adm_name = row[name_i]
+                    if latin_1:
+                        normalized_name = normalized_names.get(adm_name)
+                        if normalized_name is None:
+                            normalized_name = _normalize_latin_1_name(adm_name)
+                            normalized_names[adm_name] = normalized_name
+                        adm_name = normalized_name
+                    admin_row[name_key] = adm_name
+                # Gender and ages are derived from the population group, so the
+                # admin fields plus the group identify a row
+                admin_key = tuple(admin_row.values())
+
+                for (
+                    header_i,
+                    population_group,
+                    gender,
+                    age_range,
+                    min_age,
+                    max_age,
+                ) in population_headers:
                     population = row[header_i]
                     if population is None:
                         continue
-                    if isinstance(population, str):
-                        population = population.replace(",", "")
-                    population = int(float(population))
-                    gender, age_range = _get_gender_and_age_range(header)
-                    min_age, max_age = _get_min_and_max_age(age_range)
-                    if max_age and min_age and max_age < min_age:
-                        self.errors.add(
-                            f"{iso3}: adm{adm_level} has weird header {header}"
-                        )
-                        continue
+                    population = _parse_population(population)
 
-                    population_values = {
-                        "Population_group": header.upper(),
+                    population_row = {
+                        **admin_row,
+                        "Population_group": population_group,
                         "Gender": gender,
                         "Age_range": age_range,
                         "Age_min": min_age,
@@ -174,39 +295,33 @@ class CODPopulation:
                         "Source": source,
                         "Contributor": organization,
                     }
-                    population_row = {
-                        "ISO3": iso3,
-                        "Country": Country.get_country_name_from_iso3(iso3),
-                    }
-                    for adm_level in range(1, admin_level + 1):
-                        population_row[f"ADM{adm_level}_PCODE"] = adm_codes.get(adm_level)
-                        population_row[f"ADM{adm_level}_NAME"] = adm_names.get(adm_level)
-                    population_row.update(population_values)
                     population_rows.append(population_row)
 
-                    country_key = tuple(
-                        value
-                        for key, value in population_row.items()
-                        if key
-                        not in ["Population", "Reference_year", "Source", "Contributor"]
-                    )
+                    country_key = (admin_key, population_group)
                     if country_key in country_keys:
                         duplicates += 1
                     country_keys.add(country_key)
 
             if duplicates > 0:
-                self.errors.add(
+                errors.append(
                     f"{iso3}: {duplicates} duplicate values found in adm{admin_level}"
                 )
                 continue
-            for population_row in population_rows:
-                dict_of_lists_add(self.data, admin_level, population_row)
+            data[admin_level] = population_rows
 
         missing_levels = _check_missing_levels(missing_levels)
         if len(missing_levels) > 0:
             error_message = f"{iso3} missing unexpected admin levels: {missing_levels}"
-            if error_message not in self._configuration["known_errors"]:
-                self.errors.add(error_message)
+            if error_message not in self._known_errors:
+                errors.append(error_message)
+
+        return {
+            "data": data,
+            "reference_years": reference_years,
+            "errors": errors,
+            "year_sources": year_sources,
+            "nonmatching_headers": nonmatching_headers,
+        }
 
     def generate_dataset(self):
         dataset = Dataset(
@@ -238,52 +353,43 @@ class CODPopulation:
         return dataset
 
 
-def _get_code_headers(headers: List[str], admin_level: int) -> List[str]:
-    pattern = f"adm(in)?{admin_level}_?p?code"
-    code_headers = [
-        header for header in headers if re.match(pattern, header, re.IGNORECASE)
-    ]
-    return code_headers
+def _get_admin_headers(
+    lower_headers: List[str],
+) -> Tuple[Dict[int, List[str]], Dict[int, List[str]]]:
+    code_headers = {}
+    name_headers = {}
+    for header in lower_headers:
+        if header.startswith(_CODE_PREFIXES):
+            # The admin level follows the adm or admin prefix
+            admin_level = header[5] if header.startswith("admin") else header[3]
+            dict_of_lists_add(code_headers, int(admin_level), header)
+        match = _NAME_PATTERN.match(header)
+        if match:
+            dict_of_lists_add(name_headers, int(match[1] or match[2]), header)
+    return code_headers, name_headers
 
 
-def _get_name_headers(
-    headers: List[str], admin_level: int, non_latin_alphabets: List[str]
+def _select_name_headers(
+    name_headers: List[str], non_latin_alphabets: FrozenSet[str]
 ) -> List[str]:
-    pattern = f"(adm(in)?{admin_level}(name)?_?)((name$)|[a-z][a-z]$)"
-    other_pattern = f"^name_?{admin_level}$"
-    name_headers = [
-        header
-        for header in headers
-        if re.match(pattern, header, re.IGNORECASE)
-        or re.match(other_pattern, header, re.IGNORECASE)
-    ]
     if len(name_headers) <= 1:
         return name_headers
-    en_name_headers = [n for n in name_headers if n[-3:].lower() == "_en"]
+    en_name_headers = [n for n in name_headers if n[-3:] == "_en"]
     if len(en_name_headers) == 1:
         return en_name_headers
     latin_name_headers = [
-        n
-        for n in name_headers
-        if n[-3] == "_" and n[-2:].lower() not in non_latin_alphabets
+        n for n in name_headers if n[-3] == "_" and n[-2:] not in non_latin_alphabets
     ]
     if len(latin_name_headers) > 0:
         return latin_name_headers
     return name_headers
 
 
-def _match_population_header(header: str) -> bool:
-    total_pattern = "^[FMT]_TL$"
-    range_pattern = "^[FMT]_[0-9]{1,3}_?[0-9]{1,3}$"
-    plus_pattern = "^[FMT]_[0-9]{2,3}_?plus$"
-    match = bool(
-        re.match(total_pattern, header, re.IGNORECASE)
-        or re.match(range_pattern, header, re.IGNORECASE)
-        or re.match(plus_pattern, header, re.IGNORECASE)
-    )
-    return match
+def _match_population_header(lower_header: str) -> bool:
+    return _POPULATION_HEADER_PATTERN.fullmatch(lower_header) is not None
 
 
+@lru_cache(maxsize=1024)
 def _get_gender_and_age_range(header: str) -> Tuple[str, str]:
     components = header.lower().split("_")
     gender = components[0]
@@ -307,6 +413,7 @@ def _get_gender_and_age_range(header: str) -> Tuple[str, str]:
     return gender, age_range
 
 
+@lru_cache(maxsize=1024)
 def _get_min_and_max_age(age_range: str) -> (int | None, int | None):
     if age_range == "all" or age_range == "unknown":
         return None, None
@@ -321,6 +428,25 @@ def _get_min_and_max_age(age_range: str) -> (int | None, int | None):
     return min_age, max_age
 
 
+def _parse_population(population: str) -> int:
+    population = population.replace(",", "")
+    try:
+        return int(population)
+    except ValueError:
+        # Values such as 1234.0 or 1.5e3
+        return int(float(population))
+
+
+def _normalize_latin_1_name(adm_name: str) -> str:
+    # ASCII names are unchanged by the round trip and by NFKD
+    if adm_name.isascii():
+        return adm_name
+    try:
+        return normalize("NFKD", adm_name.encode("latin-1", "ignore").decode("utf-8"))
+    except UnicodeDecodeError:
+        return adm_name
+
+
 def _check_missing_levels(missing_levels: List[int]) -> List[int]:
     expected_missing_levels = [i for i in range(5 - len(missing_levels), 5)]
     if missing_levels == expected_missing_levels:
@@ -329,19 +455,15 @@ def _check_missing_levels(missing_levels: List[int]) -> List[int]:
 
 
 def _select_latest_resource(adm_resources: List[Resource]) -> List[Resource]:
-    adm_names = [adm_resource["name"] for adm_resource in adm_resources]
-    year_matches = [_get_resource_year(name) for name in adm_names]
-    year_matches = [int(y) for y in year_matches]
-    max_index = year_matches.index(max(year_matches))
-    if max_index == -1:
-        return adm_resources
-    adm_resources = [adm_resources[max_index]]
-    return adm_resources
+    # On a tie max returns the first resource with the latest year
+    latest_resource = max(
+        adm_resources, key=lambda adm_resource: _get_resource_year(adm_resource["name"])
+    )
+    return [latest_resource]
 
 
 def _get_resource_year(resource_name: str) -> int:
-    pattern = "(?<!\\d)2\\d{3}(?!\\d)"
-    year_matches = re.findall(pattern, resource_name, re.IGNORECASE)
-    if len(year_matches) == 0:
+    year_match = _YEAR_PATTERN.search(resource_name)
+    if year_match is None:
         return -1
-    return int(year_matches[0])
+    return int(year_match.group())
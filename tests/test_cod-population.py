@@ -1,4 +1,6 @@
+import re
 from os.path import join
+from shutil import copyfile
 
 import pytest
 from hdx.api.configuration import Configuration
@@ -195,3 +197,106 @@ class TestCODPopulation:
 
                 resources = dataset.get_resources()
                 assert len(resources) == 4
+
+    def test_download_all_country_data(
+        self, configuration, read_dataset, fixtures_dir, input_dir, config_dir
+    ):
+        with temp_dir(
+            "Test_cod_population_all",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            with Download(user_agent="test") as downloader:
+                retriever = Retrieve(
+                    downloader=downloader,
+                    fallback_dir=tempdir,
+                    saved_dir=input_dir,
+                    temp_dir=tempdir,
+                    save=False,
+                    use_saved=True,
+                )
+                serial = CODPopulation(configuration, retriever, tempdir, ErrorsOnExit())
+                serial.download_country_data("CAF")
+                serial.download_country_data("COD")
+                cod_population = CODPopulation(
+                    configuration, retriever, tempdir, ErrorsOnExit()
+                )
+                cod_population.download_all_country_data(["CAF", "COD"], max_workers=2)
+                assert cod_population.errors.errors == serial.errors.errors
+                assert cod_population.metadata == serial.metadata
+                assert cod_population.data == serial.data
+
+    def test_download_all_country_data_same_file_names(
+        self, configuration, read_dataset, monkeypatch, input_dir
+    ):
+        read_from_hdx = Dataset.read_from_hdx
+
+        # Give the csv resources of every country the same file names
+        def read_from_hdx_same_file_names(dataset_name):
+            dataset = read_from_hdx(dataset_name)
+            for resource in dataset.get_resources():
+                match = re.search("_(adm[0-9])_", resource["url"])
+                if match:
+                    resource["url"] = f"https://example.com/download/admpop_{match[1]}.csv"
+            return dataset
+
+        with temp_dir(
+            "Test_cod_population_same_file_names",
+            delete_on_success=True,
+            delete_on_failure=False,
+        ) as tempdir:
+            for iso3, filenames in {
+                "caf": (
+                    "download-caf-admpop-adm1-2015-v2.csv",
+                    "download-caf-admpop-adm2-2015-v2.csv",
+                    "download-caf-admpop-adm3-2015-v2.csv",
+                ),
+                "cod": (
+                    "download-cod-admpop-adm0-2020.csv",
+                    "download-cod-admpop-adm1-2020.csv",
+                    "download-cod-admpop-adm2-2020.csv",
+                ),
+            }.items():
+                for filename in filenames:
+                    admin_level = re.search("adm[0-9]", filename)[0]
+                    copyfile(
+                        join(input_dir, f"{iso3}_{filename}"),
+                        join(tempdir, f"{iso3}_download-admpop-{admin_level}.csv"),
+                    )
+            with Download(user_agent="test") as downloader:
+                retriever = Retrieve(
+                    downloader=downloader,
+                    fallback_dir=tempdir,
+                    saved_dir=input_dir,
+                    temp_dir=tempdir,
+                    save=False,
+                    use_saved=True,
+                )
+                serial = CODPopulation(configuration, retriever, tempdir, ErrorsOnExit())
+                serial.download_country_data("CAF")
+                serial.download_country_data("COD")
+
+                monkeypatch.setattr(
+                    Dataset,
+                    "read_from_hdx",
+                    staticmethod(read_from_hdx_same_file_names),
+                )
+                retriever = Retrieve(
+                    downloader=downloader,
+                    fallback_dir=tempdir,
+                    saved_dir=tempdir,
+                    temp_dir=tempdir,
+                    save=False,
+                    use_saved=True,
+                )
+                cod_population = CODPopulation(
+                    configuration, retriever, tempdir, ErrorsOnExit()
+                )
+                cod_population.download_all_country_data(["CAF", "COD"], max_workers=2)
+                assert cod_population.errors.errors == [
+                    "CAF: 1 duplicate values found in adm2"
+                ]
+                assert len(cod_population.data) == 4
+                assert {row["ISO3"] for row in cod_population.data[1]} == {"CAF", "COD"}
+                assert cod_population.metadata == serial.metadata
+                assert cod_population.data == serial.data